@@ -1,8 +1,15 @@
-"""To be filled in manually API keys."""
+"""To be filled in manually API keys.
 
-twitter_keys = dict(
-    app_public='',
-    app_secret='',
-    per_public='',
-    per_secret=''
-)
+Add a dict per key set; timelines are collected in parallel, with the users
+assigned to the key sets in turn.
+
+"""
+
+twitter_keys = [
+    dict(
+        app_public='',
+        app_secret='',
+        per_public='',
+        per_secret=''
+    ),
+]
@@ -1,12 +1,43 @@
 """Scripts to run the Data Collection part of the paper."""
 
+from concurrent.futures import ALL_COMPLETED
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from functools import wraps
+from itertools import islice
+import io
 import json
 from misc_keys import twitter_keys
+import os
 import pandas as pd
+from queue import Queue
+import re
+from sys import intern
+from threading import Lock
+from threading import Thread
 from time import localtime
 from time import sleep
 from time import strftime
+from time import time
 import tweepy
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+try:
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    from orjson import dumps
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+    def dumps(obj):
+        """Serialize obj to JSON bytes (orjson compatible)."""
+        return json.dumps(obj).encode('utf-8')
 
 
 def log(message):
@@ -17,10 +48,79 @@ def log(message):
 
 
 def chunk(l, n):
-    """Divide list l into n chuncks."""
-    n = int(len(l) / n)
-    for i in range(0, len(l), n):
-        yield l[i:i + n]
+    """Divide list l into n chunks, differing at most one in length."""
+    k, m = divmod(len(l), n)
+    return [l[i * k + min(i, m):(i + 1) * k + min(i + 1, m)]
+            for i in range(n)]
+
+
+def json_items(fdir, prefix=''):
+    """Iterate over the items of an object in a JSON file.
+
+    Parses the file incrementally with ijson if it is installed, so that the
+    file is never loaded as a whole. Falls back to json.load otherwise.
+
+    Parameters
+    ----------
+    fdir : str
+        File directory.
+
+    prefix : str, optional, default ''
+        Dot-separated path to the object in the file ('' for the root).
+
+    Yields
+    ------
+    item : tuple
+        (key, value) pair of the object.
+
+    """
+    with open(fdir, 'rb') as fi:
+        if ijson:
+            yield from ijson.kvitems(fi, prefix)
+        else:
+            obj = json.load(fi)
+            for key in filter(None, prefix.split('.')):
+                obj = obj[key]
+            yield from obj.items()
+
+
+def literal_re(patterns, flags=0):
+    """Compile literal patterns into a single alternation regex.
+
+    With no patterns, the regex never matches (rather than always).
+
+    """
+    return re.compile('|'.join(map(re.escape, patterns)) or '(?!)', flags)
+
+
+def query_matcher(queries):
+    """Build a function that checks if any of the queries occurs in a text.
+
+    Uses an Aho-Corasick automaton (pyahocorasick) if available, so that all
+    queries are matched in a single pass over the text. Falls back to a
+    precompiled, case-insensitive regex alternation otherwise, which does not
+    need to lowercase the text first.
+
+    Parameters
+    ----------
+    queries : iterable
+        Query strings to match (lowercase).
+
+    Returns
+    -------
+    has_query : function
+        Takes a text, returns True if any query occurs in it (ignoring case).
+
+    """
+    if ahocorasick:
+        automaton = ahocorasick.Automaton()
+        for query in queries:
+            automaton.add_word(query, query)
+        automaton.make_automaton()
+        return lambda text: next(automaton.iter(text.lower()),
+                                 None) is not None
+    pattern = literal_re(queries, re.IGNORECASE)
+    return lambda text: pattern.search(text) is not None
 
 
 def tw_connect(keys):
@@ -35,55 +135,240 @@ def tw_connect(keys):
     Returns
     -------
     api : object
-        Authenticated Tweepy API object.
+        Authenticated Tweepy API object, which sleeps when rate limited.
 
     """
     auth = tweepy.OAuthHandler(keys['app_public'], keys['app_secret'])
     auth.set_access_token(keys['per_public'], keys['per_secret'])
-    return tweepy.API(auth)
+    return tweepy.API(auth, wait_on_rate_limit=True,
+                      wait_on_rate_limit_notify=True, retry_count=3,
+                      retry_delay=5)
+
+
+def cursor_pages(cursor):
+    """Iterate over the pages of a Tweepy cursor.
+
+    Rate limits are waited out (see RateLimit and tw_connect), so an error
+    here is not worth retrying; it stops the iteration instead of
+    replaying the cursor from the first page.
+
+    Parameters
+    ----------
+    cursor : object
+        Tweepy Cursor object.
+
+    Yields
+    ------
+    page : list
+        Page of results (tweets, users) from the API.
+
+    Returns
+    -------
+    complete : bool
+        False if the iteration stopped on an error that might not occur on
+        a next try, True if the cursor ran out or the resource cannot be
+        fetched at all (protected, suspended or missing account).
+
+    """
+    pages = cursor.pages()
+    while True:
+        try:
+            page = next(pages)
+        except StopIteration:
+            return True
+        except tweepy.TweepError as e:
+            log("error fetching page: " + str(e))
+            status = getattr(e.response, 'status_code', None)
+            return status in PERMANENT_ERRORS
+        yield page
 
 try:
-    assert twitter_keys['app_public']
-    API = tw_connect(twitter_keys)
+    APIS = [tw_connect(keys) for keys in twitter_keys if keys['app_public']]
+    assert APIS
+    API = APIS[0]
 except AssertionError:
     log("API keys are empty. Please provide them in misc_keys.py...")
     exit()
 
+MAX_REQUESTS = 50  # timeline requests in flight, over all APIS
+BUFFER_SIZE = 1 << 20  # of DB files
+PERMANENT_ERRORS = (401, 403, 404)  # protected, suspended, missing user
+
+FLIP_SOURCE = """
+def flip(text, label):
+    if {filter}:  # if illegal
+        return
+    if ({tail}) and ({flip}):
+        return 'm' if label == 'f' else 'f'
+    return label
+"""
+
+
+class RateLimit(object):
+    """Request budget of an API endpoint, shared between threads.
+
+    The budget is set from the x-rate-limit headers of every response, and
+    counted down for requests in between, so that calls wait for the window
+    to reset instead of running into an error.
+
+    Attributes
+    ----------
+    remaining : int
+        Requests left in the current window, None if unknown.
+
+    reset : int
+        Epoch time at which the current window resets.
+
+    lock : obj
+        Lock held by the thread that waits for the reset.
+
+    """
+
+    def __init__(self):
+        """Start with an unknown budget."""
+        self.remaining = None
+        self.reset = 0
+        self.lock = Lock()
+
+    def acquire(self):
+        """Take a request from the budget, wait for reset if it is empty."""
+        with self.lock:
+            if self.remaining is None:
+                return
+            if self.remaining < 1:
+                wait = self.reset - time()
+                if wait > 0:
+                    log("Rate limit hit, going to zzz for {0}s...".format(
+                        int(wait) + 1))
+                    sleep(wait + 1)
+                self.remaining = None
+            else:
+                self.remaining -= 1
+
+    def update(self, response):
+        """Set the budget from the headers of an API response."""
+        headers = getattr(response, 'headers', None) or {}
+        if 'x-rate-limit-remaining' in headers:
+            with self.lock:
+                self.remaining = int(headers['x-rate-limit-remaining'])
+                self.reset = int(headers['x-rate-limit-reset'])
+
+
+RATE_LIMITS = dict()
+RATE_LIMITS_LOCK = Lock()
+
+
+def rate_limited(api, endpoint):
+    """Wrap an API endpoint so that its calls draw from a shared RateLimit.
+
+    Parameters
+    ----------
+    api : object
+        Authenticated Tweepy API object.
+
+    endpoint : str
+        Name of the API method (e.g. 'user_timeline').
+
+    Returns
+    -------
+    call : function
+        Drop-in replacement for the API method (also in a Tweepy Cursor).
+
+    """
+    with RATE_LIMITS_LOCK:
+        limit = RATE_LIMITS.setdefault((api, endpoint), RateLimit())
+    method = getattr(api, endpoint)
+
+    @wraps(method)  # also copies pagination_mode, needed by Cursor
+    def call(*args, **kwargs):
+        if kwargs.get('create'):  # Cursor asking for the method, no request
+            return method(*args, **kwargs)
+        limit.acquire()
+        result = method(*args, **kwargs)
+        # NOTE: on errors last_response is missing (no reply yet) or stale
+        limit.update(getattr(api, 'last_response', None))
+        return result
+    return call
+
 
 class DB(object):
     """Super simple database class.
 
+    Lines are stored as binary newline-delimited JSON, (de)serialized with
+    orjson if it is installed. Reads and writes go through a 1 MB buffer,
+    which is only synced to disk on commit. Can be used as a context manager
+    that commits on exit.
+
     Parameters
     ----------
     fdir : str
         File directory.
 
     mode : str
-        File mode ('r' for read, 'w' for write).
+        File mode ('r' for read, 'w' for write, 'a' for append).
 
     Attributes
     ----------
+    path : str
+        Path to the db file.
+
     db : obj
-        File object.
+        Buffered (binary) file object.
 
     """
 
     def __init__(self, db_name, mode):
         """Open file directory."""
+        self.path = './data/' + db_name + '.db'
+        self.db = None
+        self.reopen(mode)
+
+    def reopen(self, mode):
+        """Reuse the open file, only reopen it if the mode changes.
+
+        If the file is already open for reading, it is rewound. Read and
+        append modes create the file if it does not exist; only 'w' truncates.
+
+        """
+        if self.db and not self.db.closed:
+            if mode == self.mode:
+                if mode == 'r':
+                    self.db.seek(0)
+                return
+            self.commit()
         self.mode = mode
-        try:
-            self.db = open('./data/' + db_name + '.db', mode)
-        except FileNotFoundError:
-            fo = open('./data/' + db_name + '.db', 'w')
-            fo.close()
-            self.db = open('./data/' + db_name + '.db', mode)
+        if mode == 'r' and not os.path.exists(self.path):
+            open(self.path, 'ab').close()
+        raw = open(self.path, mode + 'b', buffering=0)
+        if mode == 'r':
+            self.db = io.BufferedReader(raw, BUFFER_SIZE)
+        else:
+            self.db = io.BufferedWriter(raw, BUFFER_SIZE)
+
+    def __enter__(self):
+        """Use db as context, commits on exit."""
+        return self
+
+    def __exit__(self, *exc):
+        """Commit db when leaving context."""
+        self.commit()
 
     def insert(self, jsonf):
         """Write json line to file."""
-        self.db.write(json.dumps(jsonf) + "\n")
+        self.db.write(dumps(jsonf))
+        self.db.write(b"\n")
+
+    def insert_many(self, jsonfs):
+        """Write multiple json lines to file in one go."""
+        self.db.writelines([dumps(jsonf) + b"\n" for jsonf in jsonfs])
 
     def commit(self):
-        """Write changes to disk."""
+        """Write changes to disk, does nothing if already committed."""
+        if self.db.closed:
+            return
+        if self.mode != 'r':
+            self.db.flush()
+            os.fsync(self.db.fileno())
         self.db.close()
 
     def fetch_key(self, key):
@@ -95,22 +380,28 @@ class DB(object):
         """Iterate through db."""
         assert self.mode == 'r'
         for line in self.db:
-            jsf = json.loads(line)
+            jsf = loads(line)
             yield jsf
 
 
 def reconstruct_ids(db_id):
-    """Extract query and user information from existing file."""
+    """Extract query and user information from existing file.
+
+    Labels and queries come from a small fixed set, but every parsed line
+    holds its own copy; they are interned so all entries share one string.
+
+    """
     uds = DB(db_id + '_fix', 'r')
     user_ids, query_ids = {}, {}
-    if not uds.db.read():
+    if not uds.db.peek(1):  # empty, without reading the file
+        uds.commit()
         uds = DB(db_id, 'r')
     for line in uds.loop():
         try:
-            user_ids[line['user_id']] = line['label']
-            query_ids[line['tweet_id']] = line['query']
+            user_ids[line['user_id']] = intern(line['label'])
+            query_ids[line['tweet_id']] = intern(line['query'])
         except KeyError:
-            user_ids[line['id']] = line['label']
+            user_ids[line['id']] = intern(line['label'])
     return user_ids, query_ids
 
 
@@ -166,8 +457,8 @@ class DistantCollection(object):
         hit message, and a user and tweet id.
 
     users : obj
-        Database wrapper for user table. Normal query representation doesn't
-        include these objects!
+        Database wrapper for user table (id, screen_name, description and
+        label). Normal query representation doesn't include these objects!
 
     messages : obj
         Database wrapper for message table.
@@ -184,21 +475,27 @@ class DistantCollection(object):
         Formatted dictionary combining query_string and query_words so that
         {full_query: distant_label}.
 
-    filter : list
+    filter : tuple
         See filters parameter.
 
-    flip_any : list
+    flip_any : tuple
         See flip_any parameter.
 
-    flip_prefix : list
+    flip_prefix : tuple
         See flip_prefix parameter.
 
+    query_tails : tuple
+        Characters that can directly follow a query in a self-report.
+
     user_ids : dict
         Dictionary so that {user_id : label}.
 
     query_ids : dict
         Dictionary so that {message id containing query: query}.
 
+    has_query : function
+        Matcher that returns True if a text contains any of the queries.
+
     clean_level : str
         See clean_level parameter.
 
@@ -218,11 +515,16 @@ class DistantCollection(object):
         self.hit_fix = DB(self.id + '_fix', 'a')
         self.msg_fix = DB(self.id + '_msg_fix', 'a')
 
-        self.queries = {query_string.format(k): v for
+        # NOTE: tweets are matched lowercased, so the patterns are as well
+        self.queries = {query_string.format(k).lower(): v for
                         k, v in query_words.items()}
-        self.filter = filters
-        self.flip_any = flip_any
-        self.flip_prefix = flip_prefix
+        self.has_query = query_matcher(self.queries)
+        self.filter = tuple(f.lower() for f in filters)
+        self.flip_any = tuple(f.lower() for f in flip_any)
+        self.flip_prefix = tuple(p.lower() for p in flip_prefix)
+        self.query_tails = (" ", ".", "!", ",", ":", ";")  # etc
+
+        self._flip_for_query = dict()
 
         self.user_ids = dict()
         self.query_ids = dict()
@@ -231,37 +533,59 @@ class DistantCollection(object):
         self.max = 0 if mode == 'live' else 1
 
     def remove_query_tweets(self):
-        """Remove query hits from tweets."""
-        db = DB(self.id + '_msg', 'r')
-        for line in db.loop():
+        """Remove query hits from tweets.
+
+        The fixed message table is rebuilt from all messages, so that the
+        users of earlier (resumed) runs are not written twice.
+
+        """
+        self.messages.reopen('r')
+        self.msg_fix.reopen('w')
+        for line in self.messages.loop():
             label = self.user_ids[line['user_id']]
             line['distant_label'] = label
             if self.clean_level == 'messages':
-                if not any([query in line['tweet_text'].lower()
-                            for query in self.queries]):
+                if not self.has_query(line['tweet_text']):
                     self.msg_fix.insert(line)
             else:
                 if line['tweet_id'] not in self.query_ids:
                     self.msg_fix.insert(line)
+        self.msg_fix.commit()
+
+    def _flip_rule(self, query):
+        """Return (cached) flip function for query, generated from the rules.
+
+        All patterns are fixed, so they are written into the source of the
+        function as constants: a call is a plain sequence of substring tests,
+        without attribute lookups or building patterns per tweet. The query
+        is stored as searched (in quotes), these are stripped for the rules.
+
+        """
+        if query not in self._flip_for_query:
+            def any_in(patterns):
+                return ' or '.join('{0!r} in text'.format(p)
+                                   for p in patterns) or 'False'
+            words = query.strip('"')
+            source = FLIP_SOURCE.format(
+                filter=any_in(self.filter),
+                tail=any_in(words + affix for affix in self.query_tails),
+                flip=any_in(self.flip_any + tuple(p + words for p in
+                                                  self.flip_prefix)))
+            namespace = {}
+            exec(compile(source, '<flip {0!r}>'.format(query), 'exec'),
+                 namespace)
+            self._flip_for_query[query] = namespace['flip']
+        return self._flip_for_query[query]
 
     def flip_label(self, uid, tid, text):
         """Return flipped label if rules in text, return none if in filter."""
-        query_tails = [" ", ".", "!", ",", ":", ";"]  # etc
-        if any([it in text for it in self.filter]):  # if illegal
-            return
-        label = self.user_ids[uid]
-        query = self.query_ids[tid]
-        if any([query + affix in text for affix in query_tails]):
-            if any([f in text for f in self.flip_any]):
-                label = 'm' if label == 'f' else 'f'
-            elif any([p + query in text for p in self.flip_prefix]):
-                label = 'm' if label == 'f' else 'f'
-        return label
+        flip = self._flip_rule(self.query_ids[tid])
+        return flip(text, self.user_ids[uid])
 
     def correct_query_tweets(self):
         """Correct the query tweets using heuristics, write to new file."""
-        db = DB(self.id, 'r')
-        for line in db.loop():
+        self.hits.reopen('r')
+        for line in self.hits.loop():
             new_label = self.flip_label(line['user_id'],
                                         line['tweet_id'],
                                         line['tweet_text'].lower())
@@ -272,35 +596,32 @@ class DistantCollection(object):
 
     def get_users(self, cursor, label, query):
         """Given a query cursor, store user profile and label."""
-        try:
-            for page in cursor.pages():
-                log("flipping page...")
-                for tweet in page:
-                    try:
-                        self.user_ids[tweet.user.id] = label
-                        self.query_ids[tweet.id] = query
-                        self.users.insert(tweet.user._json)
-                        self.hits.insert({'user_id': tweet.user.id,
-                                          'tweet_id': tweet.id,
-                                          'tweet_text': tweet.text,
-                                          'label': label,
-                                          'query': query})
-                    except Exception as e:
-                        log("error getting users: " + str(e))
-                if self.max:
-                    break
-
-        except tweepy.TweepError:
-            log("Rate limit hit, going to zzz....")
-            sleep(300)
-            self.get_users(cursor, label, query)
+        for page in cursor_pages(cursor):
+            log("flipping page...")
+            for tweet in page:
+                try:
+                    self.user_ids[tweet.user.id] = label
+                    self.query_ids[tweet.id] = query
+                    self.users.insert({'id': tweet.user.id,
+                                       'screen_name': tweet.user.screen_name,
+                                       'description': tweet.user.description,
+                                       'label': label})
+                    self.hits.insert({'user_id': tweet.user.id,
+                                      'tweet_id': tweet.id,
+                                      'tweet_text': tweet.text,
+                                      'label': label,
+                                      'query': query})
+                except Exception as e:
+                    log("error getting users: " + str(e))
+            if self.max:
+                break
 
     def get_queries(self):
         """Search Twitter API for tweets matching queries and fetch users."""
         for query, label in self.queries.items():
             query = '"' + query + '"'
-            cursor = tweepy.Cursor(API.search, q=query, include_entities=True,
-                                   count=200)
+            cursor = tweepy.Cursor(rate_limited(API, 'search'), q=query,
+                                   include_entities=True, count=200)
             self.get_users(cursor, label, query)
             if self.max:
                 break
@@ -312,35 +633,134 @@ class DistantCollection(object):
         self.users.commit()
         self.correct_query_tweets()
 
-    def get_tweets(self, cursor):
-        """Given a timeline cursor, fetch tweets and remove user object."""
+    def get_tweets(self, cursor, user_id):
+        """Given a timeline cursor, fetch the messages of the user.
+
+        Returns None if the timeline could not be fetched completely, and
+        might be on a next run (see cursor_pages).
+
+        """
+        pages = cursor_pages(cursor)
+        messages = []
         try:
-            for page in cursor.pages():
-                for tweet in page:
-                    tweet = tweet._json
-                    del tweet['user']
-                    yield tweet
-        except tweepy.TweepError:
-            log("Rate limit hit, going to zzz....")
-            sleep(5)
-            self.get_tweets(cursor)
-
-    def get_timelines(self):
-        """Given ID assignments, collect timelines with provided API tokens."""
-        for user_id in self.user_ids:
-            cursor = tweepy.Cursor(API.user_timeline, id=user_id, count=200)
-            for tweet in self.get_tweets(cursor):
-                tweet['user_id'] = user_id
-                assert not tweet.get('user')
-                self.messages.insert({'tweet_id': tweet['id'],
-                                      'user_id': user_id,
-                                      'tweet_text': tweet['text']})
-            log("Fetched user...")
-            if self.max:
-                break
+            while True:
+                messages.extend({'tweet_id': tweet.id,
+                                 'user_id': user_id,
+                                 'tweet_text': tweet.full_text}
+                                for tweet in next(pages))
+        except StopIteration as stop:
+            return messages if stop.value else None
+
+    def collected_users(self):
+        """Return ids (as str) of users whose timeline is already collected.
+
+        These are kept in ./data/{db_id}_done.txt, one id per line. If there is
+        no such file yet, the ids are taken from the message table once and
+        the file is written.
+
+        """
+        done_path = './data/' + self.id + '_done.txt'
+        if not os.path.exists(done_path):
+            self.messages.reopen('r')
+            done = set(str(uid) for uid in
+                       self.messages.fetch_key('user_id'))
+            self.messages.reopen('a')
+            with open(done_path, 'w') as fo:
+                fo.writelines(uid + '\n' for uid in done)
+        with open(done_path) as fi:
+            return set(fi.read().split())
+
+    def write_timelines(self, timelines, errors):
+        """Write complete timelines from the queue to the message table.
+
+        The messages of every timeline are flushed, and the user is then
+        added to the done file. If writing fails, the error is added to
+        errors and the rest of the queue is discarded.
+
+        """
+        try:
+            with open('./data/' + self.id + '_done.txt', 'a') as done:
+                for user_id, messages in iter(timelines.get, None):
+                    self.messages.insert_many(messages)
+                    self.messages.db.flush()
+                    done.write(str(user_id) + '\n')
+                    done.flush()
+        except BaseException as e:
+            errors.append(e)
+            for _ in iter(timelines.get, None):
+                pass
+
+    def collect_timeline(self, api, user_id, timelines):
+        """Given an API connection, put the timeline of a user on queue.
+
+        Incomplete timelines are dropped, so that the user is fetched again
+        on a next run instead of being marked done.
+
+        """
+        cursor = tweepy.Cursor(rate_limited(api, 'user_timeline'),
+                               id=user_id, count=200, tweet_mode='extended')
+        messages = self.get_tweets(cursor, user_id)
+        if messages is None:
+            log("Skipped user, will retry on next run...")
+            return
+        timelines.put((user_id, messages))
+        log("Fetched user...")
+
+    def get_timelines(self, done=()):
+        """Given ID assignments, collect timelines with provided API tokens.
+
+        Every user is a separate job, assigned to the API connections in
+        turn. Up to MAX_REQUESTS jobs wait on the API at the same time; the
+        next users are only submitted when these finish, so an error (or an
+        interrupt) in a job or the writer stops the collection after the
+        running jobs. A single writer thread appends their timelines to the
+        message table. Users with their id (as str) in done are skipped.
+
+        """
+        user_ids = [uid for uid in self.user_ids if str(uid) not in done]
+        n = len(APIS)
+        if self.max:
+            user_ids = user_ids[:n]
+        timelines, errors = Queue(), []
+        writer = Thread(target=self.write_timelines,
+                        args=(timelines, errors))
+        writer.start()
+        jobs = set()
+
+        def finish(return_when):
+            finished, pending = wait(jobs, return_when=return_when)
+            for job in finished:
+                job.result()
+            if errors:
+                raise errors[0]
+            return pending
+
+        try:
+            with ThreadPoolExecutor(max_workers=MAX_REQUESTS) as pool:
+                try:
+                    for i, user_id in enumerate(user_ids):
+                        if len(jobs) >= MAX_REQUESTS:
+                            jobs = finish(FIRST_COMPLETED)
+                        jobs.add(pool.submit(self.collect_timeline,
+                                             APIS[i % n], user_id, timelines))
+                    jobs = finish(ALL_COMPLETED)
+                except BaseException:
+                    for job in jobs:
+                        job.cancel()
+                    raise
+        finally:
+            timelines.put(None)
+            writer.join()
+        if errors:
+            raise errors[0]
 
     def fetch_user_tweets(self):
-        """Divide all ids amongst API connections and thread them."""
+        """Divide all ids amongst API connections and thread them.
+
+        Users collected in earlier runs (see collected_users) are skipped, so
+        an interrupted collection can simply be restarted.
+
+        """
         try:
             assert self.user_ids
         except (AssertionError, AttributeError):
@@ -349,11 +769,44 @@ class DistantCollection(object):
                 "fetch_query_tweets first!")
             self.user_ids, self.query_ids = reconstruct_ids(self.id)
 
-        self.get_timelines()
+        self.get_timelines(done=self.collected_users())
         self.messages.commit()
         if self.id == 'twitter_gender' or self.id == 'query_gender':
             self.remove_query_tweets()
 
+    def _batched_lookup(self, id_labels):
+        """Look up user profiles by id, store them with their label.
+
+        Ids are deduplicated (as strings, to match the id_str of the API) and
+        looked up in batches of 100, the maximum of the API. Every batch is
+        written to the user table at once. The pairs are consumed lazily, so
+        the first batch is sent before a streamed corpus is fully parsed.
+
+        Parameters
+        ----------
+        id_labels : iterable
+            (user_id, label) pairs, such as dict.items().
+
+        """
+        def unique_pairs():
+            seen = set()
+            for idx, label in id_labels:
+                idx = str(idx)
+                if idx not in seen:
+                    seen.add(idx)
+                    yield idx, label
+
+        lookup = rate_limited(API, 'lookup_users')
+        pairs = unique_pairs()
+        for batch in iter(lambda: dict(islice(pairs, 100)), {}):
+            log("Getting user batch...")
+            users = lookup(user_ids=list(batch))
+            self.users.insert_many(dict(user._json, label=batch[user.id_str])
+                                   for user in users)
+            if self.max:
+                break
+        self.users.commit()
+
 
 class QueryCollection(DistantCollection):
     r"""Reader class to load and store our Query corpus.
@@ -395,6 +848,9 @@ class QueryCollection(DistantCollection):
         Formatted dictionary combining query_string and query_words from the
         paper so that {full_query: distant_label}.
 
+    has_query : function
+        Matcher that returns True if a text contains any of the queries.
+
     user_ids : dict
         Dictionary so that {user_id : label}.
 
@@ -404,8 +860,8 @@ class QueryCollection(DistantCollection):
     max : int
         0 if mode == 'live' else 1
 
-    corpus : dict
-        JSON object with Query corpus.
+    corpus : generator
+        Streamed (user_id, annotation) items of the Query corpus.
 
     Notes
     -----
@@ -438,36 +894,23 @@ class QueryCollection(DistantCollection):
                        'male': 'm'}
         self.queries = {query_string.format(k): v for
                         k, v in query_words.items()}
+        self.has_query = query_matcher(self.queries)
 
         self.user_ids = dict()
 
         self.clean_level = clean_level
         self.max = 0 if mode == 'live' else 1
 
-        try:
-            self.corpus = json.load(open(corpus_dir, 'r'))
-        except FileNotFoundError:
+        if not os.path.isfile(corpus_dir):
             log("Something went wrong while loading the query corpus. " +
                 "Re-download from http://github.com/cmry/simple-queries " +
                 "and store in ./corpora")
+        self.corpus = json_items(corpus_dir, 'annotations')
 
     def fetch_users(self):
         """Collect the users in the Query corpus."""
-        userd = {}
-        for idx, info in self.corpus['annotations'].items():
-            userd[idx] = info['query_label2']
-            if len(userd) == 100:
-                log("Getting user batch...")
-                userl = list(userd.keys())
-                users = API.lookup_users(userl)
-                for user in users:
-                    user = user._json
-                    user['label'] = userd[user['id_str']]
-                    self.users.insert(user)
-                userd = {}
-                if self.max:
-                    break
-        self.users.commit()
+        self._batched_lookup((idx, info['query_label2']) for idx, info in
+                             self.corpus)
 
 
 class PlankCollection(DistantCollection):
@@ -502,8 +945,8 @@ class PlankCollection(DistantCollection):
     max : int
         0 if mode == 'live' else 1
 
-    corpus : dict
-        JSON object with English part of the TwiSty corpus.
+    corpus : generator
+        Streamed items of the English part of the TwiSty corpus.
 
     Notes
     -----
@@ -531,28 +974,16 @@ class PlankCollection(DistantCollection):
 
         self.max = 0 if mode == 'live' else 1
 
-        try:
-            self.corpus = json.load(open(corpus_dir, 'r'))
-        except FileNotFoundError:
-            log("Please request TwiSty-EN from ",
-                "http://www.clips.ua.ac.be/datasets/twisty-corpus ",
+        if not os.path.isfile(corpus_dir):
+            log("Please request TwiSty-EN from " +
+                "http://www.clips.ua.ac.be/datasets/twisty-corpus " +
                 "and store in ./corpora")
+        self.corpus = json_items(corpus_dir)
 
     def fetch_users(self):
         """Collect the users in the Plank corpus."""
-        userd = {}
-        for idx, info in self.corpus.items():
-            userd[info['user_id']] = info['gender']
-            if len(userd) == 100:
-                log("Getting user batch...")
-                userl = list(userd.keys())
-                users = API.lookup_users(userl)
-                for user in users:
-                    user = user._json
-                    user['label'] = userd[user['id_str']]
-                    self.users.insert(user)
-                userd = {}
-        self.users.commit()
+        self._batched_lookup((info['user_id'], info['gender']) for _, info in
+                             self.corpus)
 
 
 class VolkovaCollection(DistantCollection):
@@ -587,8 +1018,8 @@ class VolkovaCollection(DistantCollection):
     max : int
         0 if mode == 'live' else 1
 
-    corpus : dict
-        CSV file with English part of the TwiSty corpus.
+    corpus : obj
+        Pandas reader that iterates over the CSV corpus in chunks of rows.
 
     Notes
     -----
@@ -615,34 +1046,25 @@ class VolkovaCollection(DistantCollection):
         self.max = 0 if mode == 'live' else 1
 
         try:
-            with open(corpus_dir, 'r') as fi:
-                with open(corpus_dir + '_f', 'w') as fo:
-                    fs = fi.read()
-                    fo.write(fs.replace('::', ''))
-            with open(corpus_dir + '_f') as new_fi:
-                self.corpus = pd.DataFrame.from_csv(new_fi, sep='\t')
+            self.corpus = pd.read_csv(corpus_dir, sep='\t', index_col=0,
+                                      engine='c', chunksize=50000, dtype=str)
         except FileNotFoundError:
-            log("Please request acces to ",
-                "https://bitbucket.org/svolkova/psycho-demographics ",
-                "from Svitlana Volkova (http://www.cs.jhu.edu/~svitlana/) "
+            log("Please request acces to " +
+                "https://bitbucket.org/svolkova/psycho-demographics " +
+                "from Svitlana Volkova (http://www.cs.jhu.edu/~svitlana/) " +
                 "and store the userIDToAttributes file in ./corpora")
 
     def fetch_users(self):
         """Collect the users in the Volkova corpus."""
         userd = {}
-        for _id, cols in self.corpus.iterrows():
-            userd[_id] = 'f' if cols['gender'] == 'Female' else 'm'
-            if len(userd) == 100:
-                log("Getting user batch...")
-                userl = list(userd.keys())
-                users = API.lookup_users(userl)
-                for user in users:
-                    user = user._json
-                    user['label'] = userd[user['id_str']]
-                    self.users.insert(user)
-                userd = {}
-                if self.max:
-                    break
+        for df in self.corpus:
+            # NOTE: fields in the corpus file contain '::', strip it
+            df.index = df.index.str.replace('::', '')
+            df.columns = df.columns.str.replace('::', '')
+            female = df['gender'].str.replace('::', '').eq('Female')
+            userd.update(female.map({True: 'f', False: 'm'}).items())
+        self._batched_lookup(userd.items())
+
 
 if __name__ == "__main__":
 
@@ -1,13 +1,18 @@
 """Scripts to run the preprocessing and information parts of the paper."""
 
-import json
-# from langdetect import detect  # --- see line 165
+# from langdetect import detect  # --- see data_to_batches
+import mmap
+from operator import itemgetter
 from sec3_data import DB
+from sec3_data import json_items
 from sec3_data import reconstruct_ids
 from sec3_data import log
 from sklearn.metrics import accuracy_score
 from sklearn.metrics import cohen_kappa_score
-import spacy
+from sys import intern
+
+WHITESPACE = str.maketrans('\n\t\r', '   ')  # fasttext line, tweet separators
+LABEL_FIELDS = ('bot', 'majority', 'ann1', 'ann2', 'ann3', 'query_label2')
 
 
 class AnnotationStats(object):
@@ -54,8 +59,7 @@ class AnnotationStats(object):
 
     def __init__(self, **kwargs):
         """Open query database with annotations."""
-        self.annotations = json.load(open('./corpora/query-gender.json')
-                                     )['annotations']
+        annotations = json_items('./corpora/query-gender.json', 'annotations')
         self.paper = kwargs.get('paper', True)
         if self.paper:
             print("PLEASE NOTE: this information is for the annotation part " +
@@ -63,12 +67,17 @@ class AnnotationStats(object):
                   "Furthermore, v1 of the paper included kappa scores for " +
                   "'not sure'\nannotations, which should have been excluded " +
                   "(kappa = 0.90 then).\n")
-            self.annotations = {k: v for k, v in self.annotations.items()
-                                if int(k) < 210040000}
+            # NOTE: filtered while streaming, the rest is never materialized
+            annotations = ((k, v) for k, v in annotations
+                           if int(k) < 210040000)
         else:
             print("PLEASE NOTE: any statistics dealing with annotations in " +
                   "the paper\ndeal with a subset, reproducable by setting " +
                   "paper=True.\n\n")
+        self.annotations = dict(annotations)
+        for line in self.annotations.values():  # few distinct label values
+            for field in LABEL_FIELDS:
+                line[field] = intern(line[field])
         self.stats = dict({'bots': 0, 'total': 0, 'm': 0, 'f': 0, 'o': 0,
                            '-': 0, '0': 0, 'distant': [], 'hand': [],
                            'ann': []})
@@ -77,26 +86,39 @@ class AnnotationStats(object):
 
     def calculate_stats(self):
         """Caclulate all relevant stats."""
+        s = self.stats
+        distant, hand = s['distant'], s['hand']
         raters = {'ann1': [], 'ann2': [], 'ann3': []}
+        ann1, ann2, ann3 = raters['ann1'], raters['ann2'], raters['ann3']
+        counts = {'m': 0, 'f': 0, 'o': 0, '-': 0, '0': 0}
+        bots = total = 0
         for line in self.annotations.values():
             if line['bot'] == 'True':
-                self.stats['bots'] += 1
-            if line['majority'] in self.stats:
-                self.stats[line['majority']] += 1
-            if line['majority'] in ['m', 'f'] and line['query_label2'] != '0':
-                self.stats['distant'].append(line['query_label2'])
-                self.stats['hand'].append(line['majority'])
-            for i in range(1, 4):
-                raters['ann' + str(i)].append(line['ann' + str(i)])
-            self.stats['total'] += 1
-        self.stats['raters'] = raters
+                bots += 1
+            majority = line['majority']
+            if majority in counts:
+                counts[majority] += 1
+            if (majority == 'm' or majority == 'f') and \
+                    line['query_label2'] != '0':
+                distant.append(line['query_label2'])
+                hand.append(majority)
+            ann1.append(line['ann1'])
+            ann2.append(line['ann2'])
+            ann3.append(line['ann3'])
+            total += 1
+        s.update(counts)
+        s['bots'] = bots
+        s['total'] = total
+        s['raters'] = raters
 
     def _kappa(self, raters, y1, y2):
-        ignore = ('0', 'o') if self.paper else ('0', 'o', '-')
-        simsc = [(x, y) for x, y in zip(raters[y1],
-                                        raters[y2])
-                 if x not in ignore and y not in ignore]
-        return len(simsc), cohen_kappa_score(*zip(*simsc))
+        ignore = frozenset(('0', 'o') if self.paper else ('0', 'o', '-'))
+        xs, ys = [], []
+        for x, y in zip(raters[y1], raters[y2]):
+            if x not in ignore and y not in ignore:
+                xs.append(x)
+                ys.append(y)
+        return len(xs), cohen_kappa_score(xs, ys)
 
     def report(self):
         """Report stats according to args provided in class init."""
@@ -125,6 +147,47 @@ class AnnotationStats(object):
                 print("Kappa 1 : 3 @ ", kapl13, "\t", round(kap13, 2))
 
 
+def user_batches(db, user_ids, label_mapping, size=200):
+    """Group the messages in db into batches of tweets per user.
+
+    Parameters
+    ----------
+    db : obj
+        Database wrapper (opened for reading) with the messages.
+
+    user_ids : dict
+        Dictionary so that {user_id : label}, users not in here are skipped.
+
+    label_mapping : dict
+        A label -> int mapping to convert the labels to a number.
+
+    size : int, optional, default 200
+        Amount of tweets per batch; remaining tweets of a user are dropped.
+
+    Yields
+    ------
+    batch : tuple
+        The (tab-separated) tweets of the batch, and their (int) label as str.
+
+    """
+    batch, label, cur_user = [], str(), str()
+    fields = itemgetter('user_id', 'tweet_text')
+    for user_id, tweet_text in map(fields, db.loop()):
+        if cur_user != user_id:
+            # log("Processing " + str(user_id))
+            batch = []
+            try:
+                label = str(label_mapping[user_ids[user_id]])
+            except KeyError:
+                # log("User error...")
+                continue
+            cur_user = user_id
+        batch.append(tweet_text.translate(WHITESPACE))
+        if len(batch) == size:
+            yield '\t'.join(batch), label
+            batch = []
+
+
 def data_to_batches(db_id, label_mapping):
     """Convert messages in db to fasttext format and filter non-english.
 
@@ -146,57 +209,51 @@ def data_to_batches(db_id, label_mapping):
     """
     aff = '_fix' if 'query' in db_id or 'twitter' in db_id else ''
     db = DB(db_id + '_msg' + aff, 'r')
-    ft = open('./data/' + db_id + '.dataf', 'w')
-
-    NLP = spacy.load('en')
+    ft = open('./data/' + db_id + '.dataf', 'w', buffering=1 << 20)
 
     user_ids, _ = reconstruct_ids(db_id)
-    batch, bin_lab = [], label_mapping
-    label, cur_user = str(), str()
+    batches = user_batches(db, user_ids, label_mapping)
+    prefixes = {str(n): '__label__{0} '.format(n)
+                for n in label_mapping.values()}
 
     log("Processing " + db_id + "...")
 
-    for line in db.loop():
-        prep = "" if not cur_user else "\n"
-        if cur_user != line['user_id']:
-            # log("Processing " + str(line['user_id']))
-            batch = []
-            try:
-                label = str(bin_lab[user_ids[line['user_id']]])
-            except KeyError:
-                # log("User error...")
-                continue
-            cur_user = line['user_id']
-        if label:
-            text = line['tweet_text'].replace('\n', ' ').replace('\t', ' ')
-            batch.append(text)
-            if len(batch) == 200:
-                tweets = '\t'.join(batch)
-                # NOTE: language detection was found to hurt performance
-                # if detect(tweets) == 'en':
-                tokens = ' '.join([t.text for t in NLP.tokenizer(tweets)])
-                tokens = tweets
-                if tokens[0] == ' ':
-                    tokens = tokens[1:]
-                tokens = tokens.replace('\r', ' ')
-                log("Wrote tweet batch...")
-                ft.write(prep + '__label__{0} '.format(label) + tokens)
-                batch = []
+    # NOTE: language detection was found to hurt performance
+    # if detect(tweets) == 'en':
+    for i, (tokens, label) in enumerate(batches):
+        prep = "\n" if i else ""
+        tokens = tokens.lstrip()
+        log("Wrote tweet batch...")
+        ft.write(prep)
+        ft.write(prefixes[label])
+        ft.write(tokens)
     ft.close()
 
 
 def batches_to_sets(db_id, test_size=0.2):
     """Split fasttext batches into train and test."""
-    ft = open('./data/' + db_id + '.dataf', 'r')
-    batches = ft.read().split('\n')
-    n_test = round(len(batches) * test_size)
-    n_train = len(batches) - n_test
-    train = batches[:n_train]
-    test = batches[-n_test:]
-    with open('./data/' + db_id + '.train', 'w') as ftrain:
-        [ftrain.write(x + '\n') for x in train]
-    with open('./data/' + db_id + '.test', 'w') as ftest:
-        [ftest.write(x + '\n') for x in test]
+    fdir = './data/' + db_id
+    with open(fdir + '.dataf', 'rb') as ft, \
+            open(fdir + '.train', 'wb') as ftrain, \
+            open(fdir + '.test', 'wb') as ftest:
+        try:
+            mm = mmap.mmap(ft.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            return
+        with mm, memoryview(mm) as view:
+            n_lines, pos = int(mm[-1:] != b'\n'), mm.find(b'\n')
+            while pos != -1:
+                n_lines += 1
+                pos = mm.find(b'\n', pos + 1)
+            n_test = round(n_lines * test_size)
+            cut = 0
+            for _ in range(n_lines - n_test):
+                cut = mm.find(b'\n', cut) + 1 or len(mm)  # last line
+            for fo, start, end in ((ftrain, 0, cut), (ftest, cut, len(mm))):
+                with view[start:end] as part:
+                    fo.write(part)
+                if start < end and mm[end - 1] != ord('\n'):  # last line
+                    fo.write(b'\n')
 
 if __name__ == "__main__":
     ans = AnnotationStats(paper=True, labels=True, bots=True, agreement=True,
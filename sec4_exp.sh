@@ -11,7 +11,7 @@ MINN=3
 MAXN=3
 BUCKET=1000000
 EPOCH=20
-THREAD=20
+THREAD=${3:-20}
 
 echo "DIM: $DIM - LR: $LR - (WGRAMS: $WORDGRAMS - MINC: $MINCOUNT) - CHARS ($MINN, $MAXN) - EPS: $EPOCH \n\n"
 
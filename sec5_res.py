@@ -1,14 +1,21 @@
 """Scripts to run the experiments (and view the results)."""
 
 from collections import Counter
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import numpy as np
+from os import cpu_count
 from sklearn.base import BaseEstimator
 from sklearn.base import ClassifierMixin
 from sklearn.metrics import accuracy_score
+from subprocess import PIPE
 from subprocess import run
+import sys
 
+FASTTEXT_THREADS = 20  # default of sec4_exp.sh
 
-def fastText(train, test):
+
+def fastText(train, test, threads=FASTTEXT_THREADS, capture=False):
     """Call shell script with fixed fasttext config to train and test.
 
     Parameters
@@ -19,39 +26,83 @@ def fastText(train, test):
     test : str
         Data id of the set used to test the model on.
 
+    threads : int, optional, default FASTTEXT_THREADS
+        Amount of threads fasttext trains with.
+
+    capture : bool, optional, default False
+        If true, the output of the script is returned instead of printed.
+        Training progress is then dropped, unless the script fails.
+
+    Returns
+    -------
+    output : str or None
+        Output of the script if capture is true.
+
     """
-    run(['sh', 'sec4_exp.sh', train, test])
+    proc = run(['sh', 'sec4_exp.sh', train, test, str(threads)],
+               stdout=PIPE if capture else None,
+               stderr=PIPE if capture else None, universal_newlines=True)
+    if capture and proc.returncode:
+        print(proc.stderr, file=sys.stderr)
+    return proc.stdout
+
+
+def fastText_jobs(sets):
+    """Run fastText for all (train, test) pairs of sets in parallel.
+
+    Pairs that share a train set write the same model file, so each train
+    set is one job that runs its test sets in order. The cores are split
+    over the jobs, up to FASTTEXT_THREADS per job.
+
+    Parameters
+    ----------
+    sets : list
+        Data ids of the sets used for both training and testing.
+
+    Returns
+    -------
+    outputs : dict
+        Output of the script per (train, test) pair.
+
+    """
+    cores = cpu_count() or 1
+    workers = min(len(sets), cores)
+    threads = max(1, min(FASTTEXT_THREADS, cores // workers))
+
+    def job(train):
+        return [fastText(train, test, threads, capture=True) for test in sets]
+
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        results = ex.map(job, sets)
+        return {(train, test): output for train, outputs in zip(sets, results)
+                for test, output in zip(sets, outputs)}
 
 
 class MajorityBaseline(BaseEstimator, ClassifierMixin):
     """Standard majority baseline implementation using sklearn classes."""
 
-    def __init__(self):
-        """Set label counter."""
-        self.y_counter = Counter()
-
     def fit(self, X, y):
-        """Count the labels."""
-        for yi in y:
-            self.y_counter[yi] += 1
+        """Find the majority label."""
+        labels, counts = np.unique(np.asarray(y), return_counts=True)
+        self.majority_ = labels[counts.argmax()]
+        return self
 
     def predict(self, X):
         """Predict the majority label for the provided data."""
-        y_pred = [self.y_counter.most_common(1)[0][0]
-                  for _ in range(X.shape[0])]
-        return y_pred
+        return np.full(X.shape[0], self.majority_, dtype=object)
 
     def mb_score(self, data):
         """Score performance for majority baseline prediction."""
         y_true = []
         for d in data:
-            dat = d.split(' ')
-            y = 'f' if int(dat.pop(0).replace('__label__', '')) == 1 else 'm'
-            self.y_counter[y] += 1
-            y_true.append(y)
-        y_pred = [self.y_counter.most_common()[0][0]] * len(y_true)
+            try:
+                label = int(d[len('__label__'):d.index(' ')])
+            except ValueError:  # no label
+                continue
+            y_true.append('f' if label == 1 else 'm')
+        majority = Counter(y_true).most_common(1)[0][0]
 
-        return accuracy_score(y_true, y_pred)
+        return y_true.count(majority) / len(y_true)
 
 
 class LexiconGender(object):
@@ -80,34 +131,35 @@ class LexiconGender(object):
 
     def __init__(self):
         """Load lexcion and weights."""
-        df = pd.DataFrame.from_csv('./corpora/emnlp14gender.csv')
-        lexD = df.to_dict()
-        self._intercept = lexD['weight'].pop('_intercept')
-        self._weights = dict(lexD['weight'].items())
+        with open('./corpora/emnlp14gender.csv', encoding='utf-8',
+                  newline='') as fi:
+            reader = csv.reader(fi)
+            col = next(reader).index('weight')
+            lexD = {row[0]: float(row[col]) for row in reader}
+        self._intercept = lexD.pop('_intercept')
+        self._weights = lexD
 
     def predict(self, tokens):
         """Predict instance according to the vocab weights."""
-        val = 0
-        for token in tokens:
-            val += self._weights.get(token, 0)
-        val += self._intercept
+        get = self._weights.get
+        val = sum(get(token, 0) for token in tokens) + self._intercept
         return 'm' if val < 0 else 'f'
 
     def lex_score(self, data):
         """Score performance of the lexicon classifier given data."""
-        y_true = []
-        y_pred = []
-
-        for i, d in enumerate(data):
-            dat = d.split(' ')
+        y_true, bodies = [], []
+        for d in data:
+            if not d.startswith('__label__'):  # last line
+                continue
+            label, _, tokens = d.partition(' ')
             try:
-                y = 'f' if int(dat.pop(0).replace('__label__', '')) == 1 \
-                    else 'm'
-                y_hat = self.predict([di.lower() for di in dat])
-                y_true.append(y)
-                y_pred.append(y_hat)
-            except ValueError:  # last line
-                pass
+                label = int(label[len('__label__'):])
+            except ValueError:  # no integer label
+                continue
+            y_true.append('f' if label == 1 else 'm')
+            bodies.append(tokens)
+
+        y_pred = [self.predict(body.lower().split()) for body in bodies]
 
         return accuracy_score(y_true, y_pred)
 
@@ -115,11 +167,17 @@ class LexiconGender(object):
 if __name__ == '__main__':
     bl = MajorityBaseline()
     lg = LexiconGender()
-    for train in ['query', 'plank', 'volkova']:  # , 'twitter' ]
-        for test in ['query', 'plank', 'volkova']:  # , 'twitter' ]
+    sets = ['query', 'plank', 'volkova']  # , 'twitter' ]
+    outputs = fastText_jobs([x + '_gender' for x in sets])
+    test_data = {}
+    for test in sets:
+        with open('./data/{0}_gender.test'.format(test)) as fi:
+            test_data[test] = fi.readlines()
+    for train in sets:
+        for test in sets:
             print("\n\n>>> train: {0} \t test: {1}".format(train, test))
-            fastText(train + '_gender', test + '_gender')
-            fin = open('./data/{0}_gender.test'.format(test)).readlines()
+            print(outputs[(train + '_gender', test + '_gender')], end='')
+            fin = test_data[test]
             sscore = round(lg.lex_score(fin), 3)
             bscore = round(bl.mb_score(fin), 3)
             print("\nSap baseline @ test: {}".format(sscore))